@@ -1,4 +1,31 @@
-import ffmpy
+import argparse
+import concurrent.futures
+import csv
+import functools
+import io
+import os
+import re
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+# Sections made up of comma-separated lines (stored as lists).
+LIST_SECTIONS = frozenset(("[Events]", "[TimingPoints]", "[HitObjects]"))
+
+# [Events] types that have their startTime in the second column.
+# Storyboard objects (e.g. Sprite) and their commands are laid out differently.
+TIMED_EVENTS = frozenset(("0", "Background", "1", "Video", "2", "Break", "5", "Sample"))
+
+# What separates the keys from the values in the key-value sections (stored as dicts).
+KEY_VALUE_SEPARATORS = {
+    "[General]": ": ",
+    "[Editor]": ": ",
+    "[Metadata]": ":",
+    "[Difficulty]": ":",
+    "[Colours]": " : ",
+}
+
 
 def convert_file_to_dict(file_name: str) -> dict:
     """Converts the contents of <file_name>
@@ -11,229 +38,265 @@ def convert_file_to_dict(file_name: str) -> dict:
     # Each section is split into blank line-separated sections.
     # Meaning, new sections are separated by one blank line.
 
-    with open(file_name, "r") as file:
-        # In case we want to do anything with the file format version
-        # file_format_version = file.readline()
-
-        is_in_section = False
-        osu_file_dict = {}
-        current_header = ""
-        for line in file:
-            line = line.strip()
-            # Ignore comments
-            if line.startswith("//"):
-                continue
-            # Checking for line break, aka in between sections
-            if line == "":
-                is_in_section = False
-            else:
-                # This checks for the first line after a section break.
-                # THis means that this is the header for the section.
-                if not is_in_section:
-                    is_in_section = True
-                    current_header = line
-                    # Depending on what the current header is, we may want a list
-                    # instead of a dict to store the values.
-
-                    # e.g. difficulty = dict, hitobjects = list 
-                    if current_header == "[Events]" or current_header == "[TimingPoints]" or current_header == "[HitObjects]":
-                        osu_file_dict[current_header] = []
-                    else:
-                        osu_file_dict[current_header] = {}
-                # Standard line within the section
-                else:
-                    # Most of the headers have different behaviour for its values.
-                    # e.g. General has key: value pairs, whereas metadata has key:value pairs.
-                    if current_header == "[General]" or current_header == "[Editor]":
-                        line = line.split(": ")
-                        osu_file_dict[current_header][line[0]] = line[1]
-                    elif current_header == "[Metadata]" or current_header == "[Difficulty]":
-                        line = line.split(":")
-                        osu_file_dict[current_header][line[0]] = line[1]
-                    elif current_header == "[Colours]":
-                        line = line.split(" : ")
-                        osu_file_dict[current_header][line[0]] = line[1]
-                    else:
-                        line = line.split(",")
-                        osu_file_dict[current_header].append(line)
-
-
-        return osu_file_dict
-
-
-def speedup_osu_file(d: dict, rate: float) -> dict:
-    """Speeds up an osu! file (converted to a dictionary)
-    by <rate> times.
-    Also handles audio speedup in this stage.
+    # Reading the whole file in one go and splitting it in memory is a lot
+    # faster than going through it line by line (especially for [HitObjects]).
+    with open(file_name, "r", encoding="utf-8", buffering=1 << 20) as file:
+        data = file.read()
+
+    osu_file_dict = {}
+    # Blank lines may contain whitespace, so they're matched with a regex.
+    for section in re.split(r"\n\s*\n", data):
+        # Ignoring comments (before picking the header, since a comment can come first).
+        # Leading whitespace is kept for now, since it matters for storyboard commands.
+        lines = [line.rstrip() for line in section.splitlines()]
+        lines = [line for line in lines if line.strip() and not line.lstrip().startswith("//")]
+        # Extra blank lines (or only comments) between sections leave empty chunks.
+        if not lines:
+            continue
+
+        # The first line of a section is its header; the rest is its body.
+        # In case we want to do anything with the file format version,
+        # it ends up as a header with an empty body.
+        header, lines = lines[0].strip(), lines[1:]
+
+        # Depending on what the current header is, we may want a list
+        # instead of a dict to store the values.
+
+        # e.g. difficulty = dict, hitobjects = list
+        if header in LIST_SECTIONS:
+            # Storyboard commands are nested under their object using a leading space
+            # or underscore, so list rows keep their indentation.
+            osu_file_dict[header] = [line.split(",") for line in lines]
+            continue
+
+        lines = [line.strip() for line in lines]
+
+        # Most of the headers have different behaviour for its values.
+        # e.g. General has key: value pairs, whereas metadata has key:value pairs.
+        separator = KEY_VALUE_SEPARATORS.get(header, " : ")
+        osu_file_dict[header] = {}
+        for line in lines:
+            # Only splitting on the first separator, since values (e.g. titles)
+            # can contain the separator as well.
+            key, value = line.split(separator, 1)
+            osu_file_dict[header][key] = value
+
+    return osu_file_dict
+
+
+def scale_times(times: list, inv_rate: float) -> list:
+    """Multiplies each of <times> (integer millisecond strings) by <inv_rate>
+    (i.e. 1 / rate), rounding to the nearest millisecond.
     """
-    # Setting the difficulty name up here.
-    # I'm doing this because the rate might potentially be decreased in future steps,
-    # and I want to keep the diffnames consistent.
-    d["[Metadata]"]["Version"] = f"{d['[Metadata]']['Version']} {rate}x"
+    return np.rint(np.array(times, dtype=np.int64) * inv_rate).astype(np.int64).tolist()
 
-    # Before we do anything, we're going to simulate generating the approach rate and 
-    # overall difficulty.
-    # If either of them are >10, we will divide the rate by 1.5,
-    # and scale it up later (using the double time mod).
 
-    # I'm not going to document the calculations here;
-    # it is better documented below (when I actually set the approach rate &
-    # overall difficulty).
-    orig_rate = rate
-    approach_rate = int(d["[Difficulty]"]["ApproachRate"])
+def scale_approach_rate(approach_rate: float, rate: float) -> float:
+    """Returns the approach rate that has the same preempt
+    as <approach_rate> sped up by <rate> times.
+    """
+    # Step 1: calculate the preempt given the approach rate
     if approach_rate < 5:
         preempt = 1200 + 600 * (5 - approach_rate) / 5
     elif approach_rate > 5:
         preempt = 1200 - 750 * (approach_rate - 5) / 5
     else:
         preempt = 1200
+
+    # Step 2: adjust the preempt depending on the rate
     preempt /= rate
 
+    # Step 3: Reverse engineer the new approach rate given the new preempt
     if preempt > 1200:
-        new_approach_rate = (preempt - 1800) / -120
+        return (preempt - 1800) / -120
     elif preempt < 1200:
-        new_approach_rate = (preempt - 1950) / -150
+        return (preempt - 1950) / -150
     else:
-        new_approach_rate = 5
-    overall_difficulty = int(d["[Difficulty]"]["OverallDifficulty"])
+        return 5
+
+
+def scale_overall_difficulty(overall_difficulty: float, rate: float) -> float:
+    """Returns the overall difficulty that has the same hit window
+    as <overall_difficulty> sped up by <rate> times.
+    """
+    # Step 1: calculate the hit window
     hit_window = 80 - 6 * overall_difficulty
+
+    # Step 2: scale down the hit window according to the rate
     hit_window /= rate
-    new_overall_difficulty = (hit_window - 80) / -6
+
+    # Step 3: Reverse engineer the new overall difficulty
+    return (hit_window - 80) / -6
+
+
+def choose_rate(approach_rate: float, overall_difficulty: float, rate: float) -> tuple:
+    """Picks the rate to actually speed the map up by.
+    If the approach rate or overall difficulty would end up >10 at <rate>,
+    the rate is divided by 1.5 (to be scaled back up later using the double time mod).
+    Returns a tuple of the chosen rate and the new approach rate and overall difficulty.
+    """
+    new_approach_rate = scale_approach_rate(approach_rate, rate)
+    new_overall_difficulty = scale_overall_difficulty(overall_difficulty, rate)
 
     if new_approach_rate > 10 or new_overall_difficulty > 10:
         rate /= 1.5
+        new_approach_rate = scale_approach_rate(approach_rate, rate)
+        new_overall_difficulty = scale_overall_difficulty(overall_difficulty, rate)
 
-    # General adjustments
-    d["[General]"]["AudioLeadIn"] = round(int(d["[General]"]["AudioLeadIn"]) / rate)
-    d["[General]"]["PreviewTime"] = round(int(d["[General]"]["PreviewTime"]) / rate)
+    return rate, new_approach_rate, new_overall_difficulty
 
-    # Editor Adjustments
-    # editor_bookmarks_adjusted = [int(i) for i in d["[Editor]"]["Bookmarks"]]
-    if "Bookmarks" in d["[Editor]"]:
-        editor_bookmarks = d["[Editor]"]["Bookmarks"].split(",")
-        editor_bookmarks_adjusted = []
-        
-        for i in range(len(editor_bookmarks)):
-            editor_bookmarks_adjusted.append(round(int(editor_bookmarks[i]) / rate))
 
-        d["[Editor]"]["Bookmarks"] = ",".join([str(i) for i in editor_bookmarks_adjusted])
+def sped_up_audio_path(audio: str, rate: float) -> str:
+    """Returns the name of the sped-up .wav file for the audio file <audio>,
+    e.g. "audio.mp3" -> "1.4-audio.wav".
+    """
+    filename_no_path, _ = os.path.splitext(audio)
+    return f"{rate}-{filename_no_path}.wav"
 
 
-    # Difficulty Adjustments
+def speedup_key_value_sections(d: dict, rate: float) -> float:
+    """Speeds up the key-value sections ([General], [Editor], [Metadata], [Difficulty])
+    of an osu! file (converted to a dictionary) by <rate> times, in place.
+    Returns the rate that the timings should actually be sped up by,
+    which might be lower than <rate> (see choose_rate).
+    """
+    general = d["[General]"]
+    # Not every map has an [Editor] section.
+    editor = d.get("[Editor]", {})
+    metadata = d["[Metadata]"]
+    difficulty = d["[Difficulty]"]
 
-    # APPROACH RATE
-    # Step 1: determine the approach rate
-    approach_rate = int(d["[Difficulty]"]["ApproachRate"])
+    # Setting the difficulty name up here.
+    # I'm doing this because the rate might potentially be decreased in future steps,
+    # and I want to keep the diffnames consistent.
+    metadata["Version"] = f"{metadata['Version']} {rate}x"
 
-    # Step 2: calculate the preempt given the approach rate
-    if approach_rate < 5:
-        preempt = 1200 + 600 * (5 - approach_rate) / 5
-    elif approach_rate > 5:
-        preempt = 1200 - 750 * (approach_rate - 5) / 5
-    else:
-        preempt = 1200
+    # Before we do anything, we're going to calculate the new approach rate and
+    # overall difficulty, which might decrease the rate (see choose_rate).
+    orig_rate = rate
+    rate, new_approach_rate, new_overall_difficulty = choose_rate(
+        int(difficulty["ApproachRate"]), int(difficulty["OverallDifficulty"]), rate)
 
-    # Step 3: adjust the preempt depending on the rate
-    preempt /= rate
+    # Every time below gets scaled by the same rate,
+    # and multiplying is cheaper than dividing.
+    inv_rate = 1.0 / rate
 
-    # Step 4: Reverse engineer the new approach rate given the new preempt
-    if preempt > 1200:
-        new_approach_rate = (preempt - 1800) / -120
-    elif preempt < 1200:
-        new_approach_rate = (preempt - 1950) / -150
-    else:
-        new_approach_rate = 5
+    # General adjustments
+    general["AudioLeadIn"] = round(int(general["AudioLeadIn"]) * inv_rate)
+    general["PreviewTime"] = round(int(general["PreviewTime"]) * inv_rate)
 
-    # Step 5: set the approach rate (with 1 decimal point precision)
-    # Capping at 10 for now (might do some DT shenanigans down the line)
-    d["[Difficulty]"]["ApproachRate"] = min(round(new_approach_rate, 1), 10)
+    # The audio gets replaced with a sped-up .wav file.
+    # Using the <orig_rate> variable here because I want to keep this name
+    # consistent with the (potentially scaled down) rate.
+    general["AudioFilename"] = sped_up_audio_path(general["AudioFilename"], orig_rate)
 
-    # OVERALL DIFFICULTY
-    # Step 1: Determine the overall difficulty
-    overall_difficulty = int(d["[Difficulty]"]["OverallDifficulty"])
+    # Editor Adjustments
+    if "Bookmarks" in editor:
+        editor_bookmarks_adjusted = scale_times(editor["Bookmarks"].split(","), inv_rate)
+        editor["Bookmarks"] = ",".join(map(str, editor_bookmarks_adjusted))
 
-    # Step 2: calculate the hit window
-    hit_window = 80 - 6 * overall_difficulty
+    # Difficulty Adjustments
 
-    # Step 3: scale down the hit window according to the rate
-    hit_window /= rate
+    # Setting both with 1 decimal point precision.
+    # Capping at 10 for now (might do some DT shenanigans down the line)
+    difficulty["ApproachRate"] = min(round(new_approach_rate, 1), 10)
+    difficulty["OverallDifficulty"] = min(round(new_overall_difficulty, 1), 10)
 
-    # Step 4: Reverse engineer the new overall difficulty
-    new_overall_difficulty = (hit_window - 80) / -6
+    return rate
 
-    # Step 5: set the overall difficulty (with 1 decimal point precision)
-    # Capping at 10 for now (might do some DT shenanigans down the line)
-    d["[Difficulty]"]["OverallDifficulty"] = min(round(new_overall_difficulty, 1), 10)
 
-    # Events Adjustments
-    events = d["[Events]"]
-    events_adjusted = []
+def speedup_events(events: list, rate: float):
+    """Speeds up the [Events] rows <events> (lists of fields) by <rate> times, in place.
+    Only the events in TIMED_EVENTS are sped up; storyboard objects and commands
+    are laid out differently, and are left as they are for now.
+    """
+    # The per-row arithmetic is done column-wise with numpy.
+    # Rows have different lengths (e.g. sliders have more fields than circles),
+    # so the columns are gathered first instead of building a 2D array.
+    inv_rate = 1.0 / rate
+    timed = [i for i, event in enumerate(events) if event[0] in TIMED_EVENTS]
 
-    for event in events:
-        # Event is an array. The second element (index 1) is startTime.
-        new_event = event.copy()
-        print(new_event)
-        new_event[1] = round(int(event[1]) / rate)
+    # Event is an array. The second element (index 1) is startTime.
+    start_times = scale_times([events[i][1] for i in timed], inv_rate)
 
-        # Breaks have an endTime as well.
-        if event[0] == "2" or event[0] == "Break":
-            new_event[2] = round(int(event[2]) / rate)
+    # Breaks have an endTime as well.
+    breaks = [i for i in timed if events[i][0] == "2" or events[i][0] == "Break"]
+    end_times = scale_times([events[i][2] for i in breaks], inv_rate)
 
-        events_adjusted.append(new_event)
+    # The rows are written out straight after this, so they're updated in place.
+    for i, start_time in zip(timed, start_times):
+        events[i][1] = start_time
 
-    d["[Events]"] = events_adjusted
+    for i, end_time in zip(breaks, end_times):
+        events[i][2] = end_time
 
-    # TimingPoints Adjustments
-    timing_points = d["[TimingPoints]"]
-    timing_points_adjusted = []
 
-    for timing_point in timing_points:
-        new_timing_point = timing_point.copy()
-        # timing_point[0] is time, needs to be adjusted
-        new_timing_point[0] = round(int(timing_point[0]) / rate)
+def speedup_timing_points(timing_points: list, rate: float):
+    """Speeds up the [TimingPoints] rows <timing_points> (lists of fields)
+    by <rate> times, in place.
+    """
+    inv_rate = 1.0 / rate
 
-        # If the timing point is uninherited (timing_point[6] == 1), timing_point[1] also needs to be
-        # adjusted.
-        if timing_point[6] == "1":
-            new_timing_point[1] = float(timing_point[1]) / rate
+    # timing_point[0] is time, needs to be adjusted
+    times = scale_times([timing_point[0] for timing_point in timing_points], inv_rate)
 
-        timing_points_adjusted.append(new_timing_point)
+    # If the timing point is uninherited (timing_point[6] == 1), timing_point[1] also needs to be
+    # adjusted.
+    is_uninherited = np.array([timing_point[6] == "1" for timing_point in timing_points], dtype=bool)
+    uninherited = np.flatnonzero(is_uninherited)
+    beat_lengths = np.array([timing_points[i][1] for i in uninherited], dtype=np.float64)
+    # Beat lengths are written out unrounded, so these keep the exact division.
+    beat_lengths = (beat_lengths / rate).tolist()
 
-    d["[TimingPoints]"] = timing_points_adjusted
+    for timing_point, time in zip(timing_points, times):
+        timing_point[0] = time
 
-    # Colours Adjustments
-    # N/A
+    for i, beat_length in zip(uninherited, beat_lengths):
+        timing_points[i][1] = beat_length
 
-    # HitObjects Adjustments
+
+def speedup_hit_objects(hit_objects: list, rate: float):
+    """Speeds up the [HitObjects] rows <hit_objects> (lists of fields)
+    by <rate> times, in place.
+    """
     # This is the big tuna. The big kahuna.
-    hit_objects = d["[HitObjects]"]
-    hit_objects_adjusted = []
+    inv_rate = 1.0 / rate
 
-    for hit_object in hit_objects:
-        new_hit_object = hit_object.copy()
+    # hit_object[2] is always time, and needs to be adjusted.
+    times = scale_times([hit_object[2] for hit_object in hit_objects], inv_rate)
 
-        # hit_object[2] is always time, and needs to be adjusted.
-        new_hit_object[2] = round(int(hit_object[2]) / rate)
+    # Additionally, if the type of object is a spinner, it has an end time.
+    types = np.array([hit_object[3] for hit_object in hit_objects], dtype=np.int64)
+    is_spinner = (types & 0b00001000) != 0
+    spinners = np.flatnonzero(is_spinner)
+    end_times = scale_times([hit_objects[i][5] for i in spinners], inv_rate)
 
-        # Additionally, if the type of object is a spinner, it has an end time.
-        if int(hit_object[3]) & 0b00001000 != 0:
-            new_hit_object[5] = round(int(hit_object[5]) / rate)
+    for hit_object, time in zip(hit_objects, times):
+        hit_object[2] = time
 
-        hit_objects_adjusted.append(new_hit_object)
+    for i, end_time in zip(spinners, end_times):
+        hit_objects[i][5] = end_time
 
-    d["[HitObjects]"] = hit_objects_adjusted
 
+def speedup_osu_file(d: dict, rate: float) -> dict:
+    """Speeds up an osu! file (converted to a dictionary)
+    by <rate> times.
+    Also handles audio speedup in this stage.
+    """
+    # Holding onto the original audio file, since it gets renamed to the sped-up one.
+    audio = d["[General]"]["AudioFilename"]
 
-    # Also speeding up the audio in this step
-    # Using the <orig_rate> variable here because I want to keep this name
-    # consistent with the (potentially scaled down) rate.
+    # The rate might be decreased here (see choose_rate).
+    rate = speedup_key_value_sections(d, rate)
 
-    # I'm going to need the name of the audio file without the .mp3, 
-    # because I'm going to replace it with a .wav file.
+    speedup_events(d["[Events]"], rate)
+    speedup_timing_points(d["[TimingPoints]"], rate)
+    # Colours Adjustments
+    # N/A
+    speedup_hit_objects(d["[HitObjects]"], rate)
 
-    filename_no_path = d["[General]"]["AudioFilename"][:d["[General]"]["AudioFilename"].rfind(".")]
-    speedup_audio_file(d["[General]"]["AudioFilename"], rate, f"{orig_rate}-{filename_no_path}.wav")
-    d["[General]"]["AudioFilename"] = f"{orig_rate}-{filename_no_path}.wav"
+    # Also speeding up the audio in this step
+    speedup_audio_file(audio, rate, d["[General]"]["AudioFilename"])
 
     return d
 
@@ -242,85 +305,300 @@ def convert_dict_to_file(d: dict, outfile_path: str):
     """Outputs a dictionary <d> corresponding to a sped-up osu! file
     to a file location specified by <outfile_path>.
     """
-    with open(outfile_path, "w") as file:
-        file.write("osu file format v14\n")
-        file.write("\n")
-
-        # [General]
-        file.write("[General]\n")
-        for key, value in d["[General]"].items():
-            file.write(f"{key}: {value}\n")
-        file.write("\n")
-
-        # [Editor]
-        file.write("[Editor]\n")
-        for key, value in d["[Editor]"].items():
-            file.write(f"{key}: {value}\n")
-        file.write("\n")
-
-        # [Metadata]
-        file.write("[Metadata]\n")
-        for key, value in d["[Metadata]"].items():
-            file.write(f"{key}:{value}\n")
-        file.write("\n")
-
-        # [Difficulty]
-        file.write("[Difficulty]\n")
-        for key, value in d["[Difficulty]"].items():
-            file.write(f"{key}:{value}\n")
-        file.write("\n")
-
-        # [Events]
-        file.write("[Events]\n")
-        for line in d["[Events]"]:
-            file.write(",".join([str(thing) for thing in line]) + "\n")
-        file.write("\n")
-
-        # [TimingPoints]
-        file.write("[TimingPoints]\n")
-        for line in d["[TimingPoints]"]:
-            file.write(",".join([str(thing) for thing in line]) + "\n")
-        file.write("\n\n")
-
-        # [Colours]
-        file.write("[Colours]\n")
-        for key, value in d["[Colours]"].items():
-            file.write(f"{key} : {value}\n")
-        file.write("\n")
-
-        # [HitObjects]
-        file.write("[HitObjects]\n")
-        for i, line in enumerate(d["[HitObjects]"]):
-            # This extra if statement makes it so that the last line is NOT a newline.
-            # I'm not sure if this would break things, but .osu files typically don't 
-            # end in a newline, so better safe than sorry.
-            if i != len(d["[HitObjects]"]) - 1:
-                file.write(",".join([str(thing) for thing in line]) + "\n")
-            else:
-                file.write(",".join([str(thing) for thing in line]))
+    # Building up the whole file in memory first,
+    # so that it can be written out in one go.
+    out = io.StringIO()
+    # The comma-separated sections are written with csv.
+    # Fields are never quoted, since values like "bg.jpg" already carry their own quotes.
+    writer = csv.writer(out, quoting=csv.QUOTE_NONE, quotechar=None, lineterminator="\n")
+
+    out.write("osu file format v14\n\n")
+
+    # Sections can be missing (e.g. lots of maps don't have [Colours]),
+    # in which case they're skipped entirely rather than written out empty.
+
+    # [General]
+    general = d.get("[General]", {})
+    if general:
+        out.write("[General]\n")
+        out.writelines(f"{key}: {value}\n" for key, value in general.items())
+        out.write("\n")
+
+    # [Editor]
+    editor = d.get("[Editor]", {})
+    if editor:
+        out.write("[Editor]\n")
+        out.writelines(f"{key}: {value}\n" for key, value in editor.items())
+        out.write("\n")
+
+    # [Metadata]
+    metadata = d.get("[Metadata]", {})
+    if metadata:
+        out.write("[Metadata]\n")
+        out.writelines(f"{key}:{value}\n" for key, value in metadata.items())
+        out.write("\n")
+
+    # [Difficulty]
+    difficulty = d.get("[Difficulty]", {})
+    if difficulty:
+        out.write("[Difficulty]\n")
+        out.writelines(f"{key}:{value}\n" for key, value in difficulty.items())
+        out.write("\n")
+
+    # [Events]
+    events = d.get("[Events]", [])
+    if events:
+        out.write("[Events]\n")
+        writer.writerows(events)
+        out.write("\n")
+
+    # [TimingPoints]
+    timing_points = d.get("[TimingPoints]", [])
+    if timing_points:
+        out.write("[TimingPoints]\n")
+        writer.writerows(timing_points)
+        out.write("\n\n")
+
+    # [Colours]
+    colours = d.get("[Colours]", {})
+    if colours:
+        out.write("[Colours]\n")
+        out.writelines(f"{key} : {value}\n" for key, value in colours.items())
+        out.write("\n")
+
+    # [HitObjects]
+    hit_objects = d.get("[HitObjects]", [])
+    if hit_objects:
+        out.write("[HitObjects]\n")
+        writer.writerows(hit_objects)
+        # The last line should NOT end in a newline, so stepping back over it.
+        # I'm not sure if this would break things, but .osu files typically don't
+        # end in a newline, so better safe than sorry.
+        out.seek(out.tell() - 1)
+        out.truncate()
+
+    with open(outfile_path, "w", encoding="utf-8", buffering=1 << 20) as file:
+        file.write(out.getvalue())
+
+    return
+
+
+def transform_osu_stream(in_path: str, out_path: str, rate: float):
+    """Speeds up the osu! file at <in_path> by <rate> times,
+    writing the result to <out_path>.
+    Unlike going through convert_file_to_dict/convert_dict_to_file,
+    this goes through the file line by line and only rewrites the lines
+    that change, so no dictionary of the whole file is built.
+    Rewritten lines keep their indentation. Indented storyboard commands
+    are copied over as-is (their timings aren't sped up yet).
+    Also handles audio speedup in this stage.
+    """
+    # The rows of each comma-separated section get sped up in chunks of this many lines,
+    # using the same helpers as speedup_osu_file.
+    chunk_size = 1 << 12
+    speedup_rows = {
+        "[Events]": speedup_events,
+        "[TimingPoints]": speedup_timing_points,
+        "[HitObjects]": speedup_hit_objects,
+    }
+
+    with open(in_path, "r", encoding="utf-8", buffering=1 << 20) as in_file:
+        # The rate might be decreased (for DT) depending on the approach rate and
+        # overall difficulty, which come after [General] and [Editor].
+        # Everything before [Events] is tiny, so we hold onto it until we know the rate.
+        head = []
+        line = ""
+        for line in in_file:
+            if line.strip() == "[Events]":
+                break
+            head.append(line)
+        else:
+            # No [Events] section, so the whole file is in <head>.
+            line = ""
+
+        # Parsing the key-value sections out of <head>,
+        # so that they can be sped up the same way as in speedup_osu_file.
+        sections = {}
+        section = ""
+        for head_line in head:
+            head_line = head_line.strip()
+            if head_line.startswith("["):
+                section = head_line
+            elif section in KEY_VALUE_SEPARATORS and KEY_VALUE_SEPARATORS[section] in head_line:
+                key, value = head_line.split(KEY_VALUE_SEPARATORS[section], 1)
+                sections.setdefault(section, {})[key] = value
+
+        if "AudioFilename" not in sections.get("[General]", {}):
+            raise ValueError(f"{in_path} has no AudioFilename in its [General] section")
+        audio = sections["[General]"]["AudioFilename"]
+
+        original = {header: values.copy() for header, values in sections.items()}
+        rate = speedup_key_value_sections(sections, rate)
+
+        def rewrite_head_line(section: str, line: str) -> str:
+            """Returns <line> (from the key-value section <section>) with its new value."""
+            separator = KEY_VALUE_SEPARATORS.get(section)
+            content = line.strip()
+            if separator is None or content.startswith("//") or separator not in content:
+                return line
+
+            key = content.split(separator, 1)[0]
+            value = str(sections[section][key])
+            if value == original[section][key]:
+                return line
+
+            content = line.rstrip("\r\n")
+            newline = line[len(content):]
+            # Leading whitespace gets put back on the rewritten line.
+            prefix = content[:len(content) - len(content.lstrip())]
+            return f"{prefix}{key}{separator}{value}{newline}"
+
+        with open(out_path, "w", encoding="utf-8", buffering=1 << 20) as out_file:
+            section = ""
+            for head_line in head:
+                if head_line.startswith("["):
+                    section = head_line.strip()
+                out_file.write(rewrite_head_line(section, head_line))
+
+            # Streaming the rest of the file (starting from the [Events] header, if any).
+            # Lines wait in <pending> until their chunk is sped up:
+            # rows as (prefix, fields, newline), anything else as the line itself.
+            pending = []
+            rows = []
+
+            def flush():
+                if rows:
+                    speedup_rows[section](rows, rate)
+                for entry in pending:
+                    if isinstance(entry, str):
+                        out_file.write(entry)
+                    else:
+                        prefix, fields, newline = entry
+                        out_file.write(prefix + ",".join(map(str, fields)) + newline)
+                pending.clear()
+                rows.clear()
+
+            section = line.strip()
+            out_file.write(line)
+            for line in in_file:
+                content = line.rstrip("\r\n")
+                stripped = content.strip()
+
+                if stripped.startswith("["):
+                    flush()
+                    section = stripped
+                    out_file.write(line)
+                    continue
+
+                # Blank lines, comments, unknown sections and storyboard commands
+                # (nested under their object with a leading space or underscore)
+                # stay as they are.
+                prefix = content[:len(content) - len(content.lstrip())]
+                if (stripped == "" or stripped.startswith("//") or section not in speedup_rows
+                        or (section == "[Events]" and (prefix or stripped.startswith("_")))):
+                    pending.append(line)
+                    continue
+
+                fields = stripped.split(",")
+                rows.append(fields)
+                pending.append((prefix, fields, line[len(content):]))
+                if len(rows) >= chunk_size:
+                    flush()
+
+            flush()
+
+    speedup_audio_file(audio, rate, sections["[General]"]["AudioFilename"])
 
     return
 
 
+@functools.lru_cache(maxsize=1)
+def decode_audio_file(input_path: str) -> tuple:
+    """Decodes the audio file at <input_path>.
+    Returns a tuple of the samples (as a float32 array of shape (channels, samples))
+    and the sample rate.
+    Cached, so that speeding up the same song to multiple rates only decodes it once
+    per process (worker processes each have their own cache).
+    Only the most recent song is kept, since decoded audio is large.
+    """
+    samples, sample_rate = sf.read(input_path, dtype="float32", always_2d=True)
+
+    # soundfile gives back (samples, channels), librosa wants (channels, samples).
+    return samples.T, sample_rate
+
+
 def speedup_audio_file(input_path, rate, output_path):
     """Helper function for speeding up audio.
-    Currently also pitches up audio; I want to avoid this.
-    (Or maybe make it toggleable)
+    Uses a phase vocoder to time stretch, so the pitch stays the same.
+    (Might make pitching up toggleable, nightcore style)
     """
 
-    ff = ffmpy.FFmpeg(inputs={input_path: None}, outputs={output_path: ["-filter:a", f"atempo={rate}"]})
-    ff.run()
+    samples, sample_rate = decode_audio_file(input_path)
+
+    # Nothing to speed up, so skip the (slow) time stretch.
+    if abs(rate - 1.0) >= 1e-6:
+        samples = librosa.effects.time_stretch(samples, rate=rate)
+
+    sf.write(output_path, samples.T, sample_rate)
 
     return
 
 
+def process_rate(osu_path: str, rate: float, d: dict | None = None, stream: bool = False) -> str:
+    """Speeds up the osu! file at <osu_path> by <rate> times,
+    and writes it out next to the original difficulty.
+    If <stream> is True, the file is sped up with transform_osu_stream,
+    without building a dictionary (<d> isn't used).
+    Otherwise <d> is the file converted to a dictionary (parsed here if not given).
+    <d> gets modified in place, so each rate needs its own copy
+    (which is what pickling it over to a worker process gives us).
+    Returns the path of the new .osu file.
+    """
+    # e.g. "... [Lapse].osu" -> "... [Lapse 1.4x].osu"
+    base, _ = os.path.splitext(osu_path)
+    if base.endswith("]"):
+        outfile_path = f"{base[:-1]} {rate}x].osu"
+    else:
+        outfile_path = f"{base} {rate}x.osu"
+
+    if stream:
+        transform_osu_stream(osu_path, outfile_path, rate)
+    else:
+        if d is None:
+            d = convert_file_to_dict(osu_path)
+        new_d = speedup_osu_file(d, rate)
+        convert_dict_to_file(new_d, outfile_path)
+
+    return outfile_path
+
+
 if __name__ == "__main__":
-    # This is terrible!!!
-    # I should make all of these options
     # Better yet, add a GUI!
-    rate = 1.4
-    d = convert_file_to_dict("./Traktion - The Near Distant Future (RLC) [Lapse].osu")
-    new_d = speedup_osu_file(d, rate)
-    convert_dict_to_file(new_d, f"./Traktion - The Near Distant Future (RLC) [Lapse {rate}x].osu")
+    parser = argparse.ArgumentParser(description="Speeds up an osu! difficulty (and its audio) to several rates.")
+    parser.add_argument("osu_path", nargs="?", default="./Traktion - The Near Distant Future (RLC) [Lapse].osu",
+                        help="the .osu file to speed up")
+    parser.add_argument("--rates", type=float, nargs="+", default=[1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0],
+                        help="the rates to speed the difficulty up to")
+    # Streaming rewrites each file in one pass without building a dictionary,
+    # but keeps comments and indentation instead of normalizing the layout.
+    parser.add_argument("--stream", action="store_true",
+                        help="rewrite the .osu file line by line instead of parsing it into a dictionary")
+    # Each worker time stretches a whole song in memory (over a gigabyte at peak
+    # for a 4 minute stereo song), so only a couple run at once by default.
+    parser.add_argument("--workers", type=int, default=2,
+                        help="how many rates to process at once (each needs roughly 1 GB+ of memory)")
+    args = parser.parse_args()
+
+    # Parsing the file once (unless streaming); every rate is independent after that,
+    # so they get spread over a few processes.
+    # The audio is time stretched in-process (not by an ffmpeg subprocess), so every worker
+    # holds its own decoded copy of the song plus the stretch's working memory.
+    # That's what bounds the worker count, not the number of cores.
+    # There's also no point in having more processes than rates or cores.
+    d = None if args.stream else convert_file_to_dict(args.osu_path)
+    max_workers = max(1, min(args.workers, len(args.rates), os.cpu_count() or 1))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        speedup = functools.partial(process_rate, args.osu_path, d=d, stream=args.stream)
+        for outfile_path in executor.map(speedup, args.rates):
+            print(outfile_path)
     # print(convert_file_to_dict("./test.osu"))
-